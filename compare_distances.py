@@ -1,18 +1,23 @@
 
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from io import StringIO
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
-from subprocess import run
+from subprocess import PIPE, run
 from ete3 import Tree
 from vector_encoding import (
-    to_tree, 
     to_vector,
-    hamming_dist,
+    batch_hamming_dist,
     hamming_dist_of_encodings,
-    get_random_tree,
-    random_tree_neighbor,
-    get_all_vectors, 
+    get_random_vector,
+    random_vector_neighbor_inplace,
+    get_all_vectors_array,
+    one_hot_vectors,
+    pack_vectors,
     gen_all_newicks,
+    vec_to_newick,
     write_newicks_of_neighborhood
 )
 
@@ -20,18 +25,12 @@ def plot_random_spr_walks(nleaves=30, nsteps=10, nruns=2, output="test.pdf"):
 
     fig, ax = plt.subplots()
 
-    for _ in range(nruns):
-        run(
-            f"random_spr_walk/random_spr_walk -ntax {nleaves} -niterations {nsteps-1} -sfreq 1 > temp.log", 
-            shell=True
-        )
-        remove_line_numbering(file="temp.log")
-        read_trees_to_vector_distances(
-            file="temp.log",
-            out_file="path_vec_dists.log"
-        )
+    # walks are independent, so run them in parallel and plot serially
+    with ProcessPoolExecutor() as executor:
+        all_ys = list(executor.map(
+            _walk_vector_distances, [nleaves] * nruns, [nsteps] * nruns))
+    for ys in all_ys:
         xs = range(nsteps)
-        ys = np.genfromtxt("path_vec_dists.log", delimiter=',').flat
         ax.plot(
             # xs,
             ys,
@@ -52,18 +51,12 @@ def plot_random_spr_walk_vs_spr_distance(
 
     fig, ax = plt.subplots()
 
-    for _ in range(nruns):
-        run(
-            f"random_spr_walk/random_spr_walk -ntax {nleaves} -niterations {nsteps-1} -sfreq 1 > temp.log", 
-            shell=True
-        )
-        remove_line_numbering(file="temp.log")
-        run(
-            f"cat temp.log | rspr/rspr -pairwise 0 1 > path_rspr_dists.log",
-            shell=True
-        )
+    # walks are independent, so run them in parallel and plot serially
+    with ProcessPoolExecutor() as executor:
+        all_ys = list(executor.map(
+            _walk_rspr_distances, [nleaves] * nruns, [nsteps] * nruns))
+    for ys in all_ys:
         # xs = range(nsteps)
-        ys = np.genfromtxt("path_rspr_dists.log", delimiter=',').flat
         ax.plot(
             # xs,
             ys,
@@ -78,15 +71,57 @@ def plot_random_spr_walk_vs_spr_distance(
 
     fig.savefig(output)
 
+def _random_spr_walk_newicks(nleaves, nsteps):
+    """
+    Runs `random_spr_walk` and returns the newicks of the trees on the walk.
+    Known limitation: no seed is passed to the walker, so if it seeds itself
+    from the clock, runs started within the same clock tick (as parallel runs
+    are) can produce the same walk
+    """
+    walk = run(
+        [
+            "random_spr_walk/random_spr_walk",
+            "-ntax", str(nleaves),
+            "-niterations", str(nsteps - 1),
+            "-sfreq", "1"
+        ],
+        stdout=PIPE,
+        text=True,
+        check=True
+    )
+    return strip_line_numbering(walk.stdout.splitlines())
+
+def _walk_vector_distances(nleaves, nsteps):
+    """
+    Returns vector-encoding distances from the start of a random SPR walk
+    """
+    newicks = _random_spr_walk_newicks(nleaves, nsteps)
+    return np.array(vector_distances_from_newicks(newicks))
+
+def _walk_rspr_distances(nleaves, nsteps):
+    """
+    Returns rSPR distances from the start of a random SPR walk
+    """
+    newicks = _random_spr_walk_newicks(nleaves, nsteps)
+    # pipe newicks through rspr, and parse its output without a file
+    rspr = run(
+        ["rspr/rspr", "-pairwise", "0", "1"],
+        input="\n".join(newicks) + "\n",
+        stdout=PIPE,
+        text=True,
+        check=True
+    )
+    return read_distances(StringIO(rspr.stdout)).flatten()
+
 def make_scatterplot_from_lists(file1, file2, output="test.pdf"):
     """
     Args:
         file1 and file2: csv files that are "list-shaped"
     """
     # file listing rSPR distances
-    arr1 = np.genfromtxt(file1, delimiter=',')
+    arr1 = read_distances(file1)
     # file listing vector-encoding distances
-    arr2 = np.genfromtxt(file2, delimiter=',')
+    arr2 = read_distances(file2)
     xs = arr1.flat
     ys = arr2.flat
 
@@ -113,9 +148,9 @@ def make_scatterplot_plus_histograms_from_lists(file1, file2, output="test.pdf")
         file1 and file2: csv files that are "list-shaped"
     """
     # file listing rSPR distances
-    arr1 = np.genfromtxt(file1, delimiter=',')
+    arr1 = read_distances(file1)
     # file listing vector-encoding distances
-    arr2 = np.genfromtxt(file2, delimiter=',')
+    arr2 = read_distances(file2)
     xs = arr1.flat
     ys = arr2.flat
 
@@ -145,8 +180,8 @@ def make_scatterplot_from_matrices(file1, file2, output="test.pdf"):
     Args:
         file1 and file2: csv files that are "matrix-shaped"
     """
-    arr1 = np.genfromtxt(file1, delimiter=',')
-    arr2 = np.genfromtxt(file2, delimiter=',')
+    arr1 = read_distances(file1)
+    arr2 = read_distances(file2)
     # why 944 ??
     xs = arr1[944].flat
     ys = arr2[944].flat
@@ -177,11 +212,16 @@ def make_animation_from_matrices(
     Args:
         title_names: a list of strings to use in title per frame
     """
-    arr1 = np.genfromtxt(file1, delimiter=',')
-    arr2 = np.genfromtxt(file2, delimiter=',')
+    arr1 = read_distances(file1)
+    arr2 = read_distances(file2)
     xs = arr1[0]
     ys = arr2[0]
     n_pts = len(xs)
+    # one frame per row
+    n_frames = len(arr1)
+    # precompute jittered coordinates of all frames, shape (n_frames, n_pts, 2)
+    jitter = np.random.uniform(-0.05, 0.05, (n_frames, n_pts, 2))
+    coords_all = np.stack([arr1, arr2], axis=-1) + jitter
     
     fig, (ax, ax_text) = plt.subplots(1, 2)
     fig.set_size_inches(8, 3)
@@ -202,11 +242,7 @@ def make_animation_from_matrices(
 
     def animate(i):
     
-        xs = arr1[i] + np.random.uniform(-0.05, 0.05, n_pts)
-        ys = arr2[i] + np.random.uniform(-0.05, 0.05, n_pts)
-        sc.set_offsets(
-            list(zip(xs, ys))
-        )
+        sc.set_offsets(coords_all[i])
         vec = title_names[i]
         st = fig.suptitle(
             "distances from tree " + str(i) + ": code " + str(vec))
@@ -218,7 +254,7 @@ def make_animation_from_matrices(
         fig,
         animate,
         interval=400,
-        save_count=945
+        save_count=n_frames
     )
     ani.save(output)
 
@@ -233,25 +269,26 @@ def write_random_sample_newicks(n=30, num_trees=100, file="test.log"):
     """
     with open(file, 'w') as fh:
         for _ in range(num_trees):
-            tree = get_random_tree(n)
-            newick = tree.write(format=9)
+            newick = vec_to_newick(get_random_vector(n))
             print(newick, file=fh)
 
-def write_pairwise_vec_distances(n=4, file="test.log"):
+def write_pairwise_vec_distances(n=4, file="test.log", block_size=1024):
     """
     Writes a matrix of vector distances to an output file,
     where rows and columns are indexed by integer vectors
     encoding trees on n leaves
+    Args:
+        block_size: number of rows of the distance matrix computed at once
     """
+    one_hot = one_hot_vectors(get_all_vectors_array(n))
+    length = n - 1
     with open(file, 'w') as fh:
-
-        for vec1 in get_all_vectors(n):
-            dists = []
-            for vec2 in get_all_vectors(n):
-                dist = hamming_dist(vec1, vec2)
-                dists.append(dist)
-            line = ",".join(str(d) for d in dists)
-            print(line, file=fh)
+        for start in range(0, len(one_hot), block_size):
+            block = one_hot[start:start + block_size]
+            # distance = length - number of agreeing entries
+            agreements = (block @ one_hot.T).astype(np.int32)
+            dists = length - agreements
+            np.savetxt(fh, dists, fmt='%d', delimiter=',')
 
 def write_random_tree_pair(n=15, file="test.log"):
     tree1 = Tree(); tree1.populate(n)
@@ -264,40 +301,64 @@ def write_random_tree_pair(n=15, file="test.log"):
         print(tree2.write(format=9), file=fh)
 
 def write_random_tree_path(n_leaves=30, n_steps=10, file="test.log"):
-    next_tree = Tree()
-    next_tree.populate(n_leaves)
+    start_tree = Tree()
+    start_tree.populate(n_leaves)
+    # walk on vector encodings, which are written directly as newicks
+    vec = to_vector(start_tree)
     with open(file, 'w') as fh:
         for _ in range(n_steps):
-            next_tree = random_tree_neighbor(next_tree)
-            print(next_tree.write(format=9), file=fh)
+            random_vector_neighbor_inplace(vec)
+            fh.write(vec_to_newick(vec) + "\n")
+
+def read_distances(file):
+    """
+    Reads a comma-separated file (path or file object) of integer distances
+    into a 2D np.int32 array; a "list-shaped" file gives a single row
+    """
+    return np.loadtxt(file, delimiter=',', dtype=np.int32, ndmin=2)
 
 def read_trees_to_vector_distances(file="test.log", out_file=None):
-    dists = []
     with open(file, 'r') as fh:
         newicks = fh.read().splitlines()
-    first_vec = to_vector(Tree(newicks[0]))
-    for newick in newicks:
-        other_vec = to_vector(Tree(newick))
-        dists.append(hamming_dist(first_vec, other_vec))
+    dists = vector_distances_from_newicks(newicks)
     if out_file is None:
         return dists
     else:
         with open(out_file, 'w') as fh:
             fh.write(",".join(str(x) for x in dists))
 
+def vector_distances_from_newicks(newicks):
+    """
+    Returns a list of vector-encoding distances from the first tree in
+    `newicks` to each tree in `newicks`
+    """
+    # stack encodings, so that all distances to the first tree are computed in
+    # one batch; walks often revisit trees, so encodings are cached by newick
+    vecs = np.stack([_encode(newick) for newick in newicks])
+    return batch_hamming_dist(vecs, vecs[0]).tolist()
+
+@lru_cache(maxsize=8192)
+def _encode(newick):
+    # encodings are packed once here, so that distances compare fewer bytes;
+    # cached arrays are shared between calls, so make them read-only
+    vec = pack_vectors(to_vector(Tree(newick)))
+    vec.setflags(write=False)
+    return vec
+
 def remove_line_numbering(file="test.log"):
     with open(file, 'r') as fh:
         lines = fh.read().splitlines()
-    newicks = []
-    for line in lines:
-        if ':' in line:
-            (_, newick) = line.split(': ')
-        else: newick = line
-        newicks.append(newick)
+    newicks = strip_line_numbering(lines)
     with open(file, 'w') as fh:
         for newick in newicks:
             print(newick, file=fh)
 
+def strip_line_numbering(lines):
+    """
+    Removes "<number>: " prefixes, as printed by `random_spr_walk`, from lines
+    """
+    return [line.split(': ', 1)[-1] for line in lines]
+
 
 if __name__ == "__main__":
 
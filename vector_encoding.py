@@ -5,11 +5,18 @@ The encoding works via applying a canonical edge labelling to the tree; the
 vector then records where leaves are added iteratively
 """
 
+import re
+import warnings
 from random import randrange
+from collections import defaultdict
+from functools import lru_cache
 from itertools import combinations_with_replacement
+from math import prod
 from typing import (
     List
 )
+import numpy as np
+from numba import njit
 from ete3 import Tree
 
 def to_vector(tree):
@@ -17,6 +24,8 @@ def to_vector(tree):
     args:
         tree: ete3.Tree object. tree is assumed to be rooted 
             and bifurcating, and have distinct leaf names.
+    Returns:
+        np.int32 array of length n - 1, where n is the number of leaves
     """
     if not tree.is_root():
         raise ValueError("input tree should be rooted")
@@ -25,9 +34,9 @@ def to_vector(tree):
     assert n_leaves >= 1
     # handle small cases, < 2 leaves
     if n_leaves == 1:
-        return []
+        return np.zeros(0, dtype=np.int32)
     elif n_leaves == 2:
-        return [0]
+        return np.zeros(1, dtype=np.int32)
     
     # tree has 3 or more leaves
     sorted_leaves = sorted(tree.get_leaf_names())
@@ -35,48 +44,82 @@ def to_vector(tree):
     for (idx, name) in enumerate(sorted_leaves):
         leaf_to_idx[name] = idx
     
-    # perform internal node labelling
+    # perform internal node labelling, and record tree structure in dicts
+    # keyed by node id; these are mutated during deconstruction instead of a
+    # copy of the tree
+    parent = {id(tree): None}
+    children = defaultdict(list)
+    label = {}
+    leaf_dict = {}
     for node in tree.traverse(strategy='postorder'):
         if node.is_leaf():
             idx = leaf_to_idx[node.name]
             node.parent_edge_label = idx
             node.min_label_below = idx
+            leaf_dict[idx] = id(node)
         else:
             # `min_label_below` = minimum label of descendant subclade 
             children_mins = [child.min_label_below for child in node.children]
             node.min_label_below = min(children_mins)
             node.parent_edge_label = - max(children_mins)
+            for child in node.children:
+                parent[id(child)] = id(node)
+                children[id(node)].append(id(child))
+        label[id(node)] = node.parent_edge_label
     
     # initialize encoding vector
     vector = []
     # fill in vector via tree deconstruction, removing one leaf at a time
-    # copy tree
-    tree_copy = Tree(
-        tree.write(
-            features=["parent_edge_label"], 
-            format_root_node=True,
-            format=9))
-    # add "grandparent-root" node so that every node in `tree_copy` has a parent
-    tree_grandparent = Tree()
-    tree_grandparent.add_child(tree_copy)
-    # construct leaf dictionary for `tree_grandparent`
-    leaf_dict = {}
-    for node in tree_grandparent.traverse(strategy='postorder'):
-        if node.is_leaf():
-            idx = leaf_to_idx[node.name]
-            leaf_dict[idx] = node
     for i in range(n_leaves - 1):
         idx = n_leaves - 1 - i
         # find sister node of leaf idx
         leaf = leaf_dict[idx]
-        sister = leaf.get_sisters()[0]
+        leaf_parent = parent[leaf]
+        sister = [c for c in children[leaf_parent] if c != leaf][0]
         # assign vector entry
-        vector.append(int(sister.parent_edge_label))
-        # delete node, and its parent, from tree_copy
-        leaf.up.up.add_child(sister)
-        leaf.up.detach()
+        vector.append(int(label[sister]))
+        # delete node, and its parent, from tree structure
+        grandparent = parent[leaf_parent]
+        parent[sister] = grandparent
+        if grandparent is not None:
+            siblings = children[grandparent]
+            siblings[siblings.index(leaf_parent)] = sister
     vector.reverse()
-    return vector
+    return np.asarray(vector, dtype=np.int32)
+
+@lru_cache(maxsize=128)
+def _default_leaf_names(n_leaves):
+    """
+    Returns default names ('aa', 'ab', 'ac', ...), i.e. i written in base 26
+    with digits 'a' to 'z', padded to the width needed for n_leaves names
+    """
+    width = 1
+    while 26 ** width < n_leaves:
+        width += 1
+    # base-26 digits of each index, most significant first
+    place_values = 26 ** np.arange(width - 1, -1, -1, dtype=np.int64)
+    digits = (np.arange(n_leaves, dtype=np.int64)[:, None] // place_values) % 26
+    codes = (digits + 97).astype(np.uint8)
+    return tuple(codes.view(f"S{width}").ravel().astype(str).tolist())
+
+def _leaf_names(n_leaves, names=None):
+    """
+    Returns a list of (at least) n_leaves leaf names; default names are
+    generated if `names` is None
+    """
+    if names is None:
+        names = list(_default_leaf_names(n_leaves))
+    else:
+        # ensure that `names` is a list of strings
+        names = list(names) # names.copy()
+        for i, name in enumerate(names):
+            names[i] = str(name)
+    # ensure that enough names are provided
+    if len(names) < n_leaves:
+        raise ValueError(
+            "must provide at least n + 1 names, where n is the "
+            "length of the encoding vector")
+    return names
 
 def to_tree(vector, names=None):
     """
@@ -89,7 +132,7 @@ def to_tree(vector, names=None):
     """
     # check input vector is "proper"
     for i, vi in enumerate(vector):
-        assert isinstance(vi, int), (
+        assert isinstance(vi, (int, np.integer)), (
             f"input vector should should have int entries; given input={vector}"
         )
         assert abs(vi) <= i, (
@@ -97,23 +140,7 @@ def to_tree(vector, names=None):
             f"(inclusive), given input has vector[{i}]={vi}"
         )
     n_leaves = len(vector) + 1
-    if names is None:
-        # generate default names ['aa', 'ab', 'ac', ...]
-        names = [chr(97 + i % 26) for i in range (n_leaves)]
-        period = 26
-        while period < n_leaves:
-            names = [names[i // period][-1] + names[i] for i in range(n_leaves)]
-            period = 26 * period
-    else:
-        # ensure that `names` is a list of strings
-        names = list(names) # names.copy()
-        for i, name in enumerate(names):
-            names[i] = str(name)
-    # ensure that enough names are provided
-    if len(names) < n_leaves:
-        raise ValueError(
-            "must provide at least n + 1 names, where n is the "
-            "length of the encoding vector")
+    names = _leaf_names(n_leaves, names)
 
     # initialize label-to-node dictionary, to avoid cost of tree search
     label_to_node = {}
@@ -148,6 +175,101 @@ def to_tree(vector, names=None):
     final_tree.up = None
     return final_tree
 
+"""
+Integer-array versions, which avoid building ete3 trees
+"""
+
+# characters which ete3 replaces by "_" when writing (unquoted) newick names
+_ILLEGAL_NEWICK_CHARS = re.compile(r"[:;(),\[\]\t\n\r=]")
+
+@njit(cache=True)
+def _to_tree_int(vector, n_leaves):
+    # leaf i has node id i; the internal node with label -i has id n_leaves + i - 1
+    n_nodes = 2 * n_leaves - 1
+    parents = np.full(n_nodes, -1, dtype=np.int32)
+    labels = np.zeros(n_nodes, dtype=np.int32)
+    for i in range(1, n_leaves):
+        idx = vector[i - 1]
+        # get node with label=idx
+        if idx >= 0:
+            subtree = idx
+        else:
+            subtree = n_leaves - 1 - idx
+        # attach i-th leaf as sister of `subtree`, subdividing its parent-edge
+        new_node = n_leaves + i - 1
+        parents[new_node] = parents[subtree]
+        parents[subtree] = new_node
+        parents[i] = new_node
+        labels[new_node] = -i
+        labels[i] = i
+    return parents, labels
+
+def to_tree_int(vector):
+    """
+    Integer-array version of `to_tree`
+    Args:
+        vector: integer vector with i-th entry in range {-i, ..., i}
+    Returns:
+        (parents, labels): np.int32 arrays indexed by node id, giving the
+            parent of each node (-1 at the root) and its parent-edge label.
+            Leaf i has node id i, and the internal node with label -i has
+            node id n + i - 1, where n is the number of leaves
+    """
+    array = np.asarray(vector)
+    # an empty list has a float dtype, but is a valid (1-leaf) encoding
+    if array.size > 0 and not np.issubdtype(array.dtype, np.integer):
+        raise ValueError(
+            f"input vector should should have int entries; given input={vector}")
+    vector = array.astype(np.int32)
+    bounds = np.arange(len(vector))
+    if np.any(np.abs(vector) > bounds):
+        i = int(np.argmax(np.abs(vector) > bounds))
+        raise ValueError(
+            f"vector entry vector[{i}] should be between -{i} and {i} "
+            f"(inclusive), given input has vector[{i}]={vector[i]}")
+    return _to_tree_int(vector, len(vector) + 1)
+
+def emit_newick(parents, labels, names=None):
+    """
+    Returns the newick string, with leaf names only (as in ete3's format=9),
+    of a tree given as arrays (parents, labels) by `to_tree_int`. Children
+    are written in the same order as in the ete3 tree built by `to_tree`, and
+    newick-illegal characters in names are replaced by "_" as ete3 does.
+    """
+    n_leaves = (len(parents) + 1) // 2
+    names = _leaf_names(n_leaves, names)
+    # children in order of creation, i.e. of absolute edge label
+    children = [[] for _ in range(len(parents))]
+    root = None
+    for node in np.argsort(np.abs(labels), kind='stable').tolist():
+        if parents[node] < 0:
+            root = node
+        else:
+            children[parents[node]].append(node)
+    # iterative traversal, since trees can be deeper than the recursion limit
+    tokens = []
+    stack = [root]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            tokens.append(item)
+        elif item < n_leaves:
+            tokens.append(_ILLEGAL_NEWICK_CHARS.sub("_", names[item]))
+        else:
+            (left, right) = children[item]
+            tokens.append("(")
+            stack.extend([")", right, ",", left])
+    tokens.append(";")
+    return "".join(tokens)
+
+def vec_to_newick(vector, names=None):
+    """
+    Returns the newick string (leaf names only) of the tree encoded by
+    vector; same as `to_tree(vector, names).write(format=9)`, without
+    building an ete3 tree
+    """
+    return emit_newick(*to_tree_int(vector), names=names)
+
 """
 Multifurcating versions
 """
@@ -173,11 +295,14 @@ def to_vector_multifurcating(tree, debugging=False):
     # if tree has 2 or more leaves
     sorted_leaves = sorted(tree.get_leaf_names())
     if debugging: print("sorted_leaves:", sorted_leaves)
+    leaf_to_idx = {}
+    for (idx, name) in enumerate(sorted_leaves):
+        leaf_to_idx[name] = idx
     
     # perform (parent-)edge labelling
     for node in tree.traverse(strategy='postorder'):
         if node.is_leaf():
-            idx = sorted_leaves.index(node.name)
+            idx = leaf_to_idx[node.name]
             node.parent_edge_label = [idx]
             node.unmatched_labels = [idx]
         else:
@@ -261,22 +386,99 @@ Utils
 
 def test_vector_idempotent(n=30):
     vec = get_random_vector(n)
-    assert vec == to_vector(to_tree(vec))
+    assert np.array_equal(vec, to_vector(to_tree(vec)))
+    print("Passed test with vector = ", vec)
+
+def test_vec_to_newick(n=30):
+    vec = get_random_vector(n)
+    assert vec_to_newick(vec) == to_tree(vec).write(format=9)
+    names = [f"leaf {i}:(x,y);[z]=\t" for i in range(n)]
+    assert vec_to_newick(vec, names) == to_tree(vec, names).write(format=9)
     print("Passed test with vector = ", vec)
 
 def test_ete_vector_idempotent(n=30):
     t = Tree()
     t.populate(n)
     vec = to_vector(t)
-    assert vec == to_vector(to_tree(vec))
+    assert np.array_equal(vec, to_vector(to_tree(vec)))
     print("Passed test with tree = ", t.write(format=9), t)
 
+@njit(cache=True)
+def _hamming_dist_i32(vec1, vec2):
+    acc = 0
+    for k in range(min(vec1.shape[0], vec2.shape[0])):
+        acc += (vec1[k] != vec2[k])
+    return acc
+
+@njit(cache=True)
+def _hamming_dist_batch(vecs, ref):
+    dists = np.zeros(vecs.shape[0], dtype=np.int64)
+    for row in range(vecs.shape[0]):
+        acc = 0
+        for k in range(ref.shape[0]):
+            acc += (vecs[row, k] != ref[k])
+        dists[row] = acc
+    return dists
+
 def hamming_dist(vec1, vec2):
     """
     Computes hamming distance between input vectors
     """
+    if isinstance(vec1, np.ndarray) and isinstance(vec2, np.ndarray):
+        return int(_hamming_dist_i32(vec1, vec2))
     return sum(a != b for (a, b) in zip(vec1, vec2))
 
+def pack_vectors(vecs):
+    """
+    Casts encoding vectors to the narrowest signed integer type which holds
+    all of their entries, e.g. np.int8 for trees on at most 129 leaves (the
+    largest entry is n - 2), so that distance computations touch fewer bytes.
+    The cast copies, so pack vectors once where they are made, not per
+    distance computation
+    Args:
+        vecs: integer array whose last axis indexes vector entries
+    """
+    vecs = np.asarray(vecs)
+    # the i-th entry of an encoding vector lies in the range [-i, i]
+    max_entry = max(vecs.shape[-1] - 1, 0)
+    for dtype in (np.int8, np.int16, np.int32):
+        if max_entry <= np.iinfo(dtype).max:
+            return vecs.astype(dtype, copy=False)
+    return vecs.astype(np.int64, copy=False)
+
+def one_hot_vectors(vecs):
+    """
+    Returns a 0/1 np.float32 array of shape (N, L * L) for an (N, L) array of
+    encoding vectors, where the 2i + 1 columns starting at column i * i mark
+    the value of the i-th entry. The number of entries on which two vectors
+    agree is then the dot product of their rows, so hamming distances for
+    many pairs reduce to one matrix product
+    """
+    vecs = np.asarray(vecs)
+    (n_vecs, length) = vecs.shape
+    # column of value v at position i is i * i + (v + i)
+    offsets = np.arange(length) ** 2 + np.arange(length)
+    one_hot = np.zeros((n_vecs, length * length), dtype=np.float32)
+    one_hot[np.arange(n_vecs)[:, None], vecs + offsets] = 1
+    return one_hot
+
+def batch_hamming_dist(vecs, ref):
+    """
+    Computes hamming distance between each row of `vecs` and the vector `ref`
+    Args:
+        vecs: 2D integer array, with one encoding vector per row; the
+            computation runs in the dtype of `vecs`, e.g. as produced by
+            `pack_vectors`
+        ref: integer vector, with the same length as the rows of `vecs`
+    Returns:
+        np.int64 array of distances, one per row of `vecs`
+    """
+    vecs = np.asarray(vecs)
+    ref = np.asarray(ref).astype(vecs.dtype, copy=False)
+    if vecs.shape[1:] != ref.shape:
+        raise ValueError("rows of `vecs` and `ref` should have the same length")
+    return _hamming_dist_batch(vecs, ref)
+
 def hamming_dist_of_encodings(tree1, tree2):
     """
     Computes hamming distance between vector encodings of input trees.
@@ -338,27 +540,38 @@ def get_random_tree(n=30):
     vec = get_random_vector(n)
     return to_tree(vec)
 
-def get_all_vectors(n=4):
+def get_all_vectors(n=4, chunk_size=65536):
     """
     Returns an iterator which yields all integer vectors of length n - 1,
     which satisfy the constraint that the i-th entry is in the range [-i, i]
+    Args:
+        chunk_size: number of vectors generated at once, as in
+            `get_all_vectors_array`
     """
-    vec = [-i for i in range(n - 1)]
-    max_reached = False
-    while not max_reached:
-        yield vec.copy()
-
-        # increment vector
-        vec[-1] += 1
-        # carry terms
-        for i in range(n-2, 0, -1):
-            if vec[i] > i:
-                # carry term
-                vec[i] = -i
-                vec[i - 1] += 1
-        # check if max reached
-        if vec[0] > 0:
-            max_reached = True
+    n_vecs = prod(2 * i + 1 for i in range(n - 1))
+    for start in range(0, n_vecs, chunk_size):
+        yield from get_all_vectors_array(n, start, start + chunk_size)
+
+def get_all_vectors_array(n=4, start=0, stop=None):
+    """
+    Returns a 2D np.int32 array whose rows are all integer vectors of length
+    n - 1 which satisfy the constraint that the i-th entry is in the range
+    [-i, i], in the same order as `get_all_vectors`
+    Args:
+        start, stop: if given, only rows start, ..., stop - 1 are returned
+    """
+    # the i-th entry is a mixed-radix digit with 2i + 1 possible values
+    shape = tuple(2 * i + 1 for i in range(n - 1))
+    n_vecs = prod(shape)
+    stop = n_vecs if stop is None else min(stop, n_vecs)
+    indices = np.arange(start, stop, dtype=np.int64)
+    if len(shape) == 0:
+        return np.zeros((len(indices), 0), dtype=np.int32)
+    digits = np.unravel_index(indices, shape)
+    vecs = np.stack(digits, axis=1).astype(np.int32)
+    # shift digits from [0, 2i] to [-i, i]
+    vecs -= np.arange(n - 1, dtype=np.int32)
+    return vecs
 
 def get_all_treeshape_vectors(n=4):
     """
@@ -393,19 +606,27 @@ def get_all_treeshapes(n=4):
     for vec in get_all_treeshape_vectors(n):
         yield to_tree(vec)
 
+@njit(cache=True)
+def _vector_neighborhood_i32(start_vec):
+    n = start_vec.shape[0]
+    # at most 2i + 1 choices of entry at position i, i.e. n * n rows in total
+    neighbors = np.empty((n * n, n), dtype=np.int32)
+    row = 0
+    for i in range(n):
+        for entry in range(-i, i + 1):
+            if entry == start_vec[i]:
+                continue
+            neighbors[row, :] = start_vec
+            neighbors[row, i] = entry
+            row += 1
+    return neighbors[:row]
+
 def get_vector_neighborhood(start_vec):
     """
     Returns a list of vectors which have hamming distance 1 from start_vec
     """
-    neighbors = []
-    for i in range(len(start_vec)):
-        for entry in range(-i, i + 1):
-            if entry == start_vec[i]:
-                continue
-            new_vec = start_vec.copy()
-            new_vec[i] = entry
-            neighbors.append(new_vec)
-    return neighbors
+    start_vec = np.asarray(start_vec, dtype=np.int32)
+    return list(_vector_neighborhood_i32(start_vec))
 
 def get_tree_neighborhood(start_tree):
     """
@@ -415,6 +636,20 @@ def get_tree_neighborhood(start_tree):
     start_vec = to_vector(start_tree)
     return [to_tree(vec) for vec in get_vector_neighborhood(start_vec)]
 
+@njit(cache=True)
+def _set_random_neighbor_entry(vec, i, j):
+    k = max(i, j)
+
+    old_val = vec[k]
+    # set new_val to i - j, which is nonzero since i != j
+    new_val = i - j
+    # modify new_val to guarantee it is new: a positive value is moved down
+    # if it is <= old_val, a negative value is moved up if it is >= old_val
+    new_val -= (0 < new_val) & (new_val <= old_val)
+    new_val += (old_val <= new_val) & (new_val < 0)
+    vec[k] = new_val
+    return k, old_val
+
 def random_vector_neighbor(start_vec):
     """
     Returns a "proper" integer vector which has hamming distance 1 
@@ -426,28 +661,26 @@ def random_vector_neighbor(start_vec):
         modify entry to -i. However, we make a slight adjustment to guarantee
         modified entry is different from old entry 
     """
-    n = len(start_vec)
+    new_vec = np.array(start_vec, dtype=np.int32)
+    random_vector_neighbor_inplace(new_vec)
+    return new_vec
+
+def random_vector_neighbor_inplace(vec):
+    """
+    Like `random_vector_neighbor`, but modifies `vec` (an np.int32 array) in
+    place instead of copying it
+    Returns:
+        (k, old_val), the modified position and its previous entry, so that
+        the step can be undone with `vec[k] = old_val`
+    """
+    n = len(vec)
     i = randrange(0, n)
     j = randrange(0, n - 1)
     # guarantee that i != j
     if j >= i:
         j += 1
-    k = max(i, j)
-
-    old_val = start_vec[k]
-    # set new_val to i - j
-    new_val = i - j
-    if new_val > 0:
-        # modify new_val to guarantee it is new
-        if new_val <= old_val:
-            new_val -= 1
-    else: # new_val is negative
-        # modify new_val to guarantee it is new
-        if new_val >= old_val:
-            new_val += 1
-    new_vec = start_vec.copy()
-    new_vec[k] = new_val
-    return new_vec
+    (k, old_val) = _set_random_neighbor_entry(vec, i, j)
+    return (int(k), int(old_val))
 
 def lazy_random_vector_neighbor(start_vec):
     """
@@ -466,6 +699,15 @@ def lazy_random_vector_neighbor(start_vec):
     return new_vec
 
 def random_tree_neighbor(start_tree):
+    """
+    Deprecated: encodes and decodes the tree at every call; random walks
+    should keep the vector as state and use `random_vector_neighbor`
+    """
+    warnings.warn(
+        "random_tree_neighbor is deprecated, use random_vector_neighbor on "
+        "the vector encoding instead",
+        DeprecationWarning,
+        stacklevel=2)
     start_vec = to_vector(start_tree)
     new_vec = random_vector_neighbor(start_vec)
     return to_tree(new_vec)
@@ -482,8 +724,7 @@ def write_newicks_of_neighborhood(start_vec, file="test.log"):
     nbhd_vecs = get_vector_neighborhood(start_vec)
     with open(file, 'w') as fh:
         for vec in nbhd_vecs:
-            tree = to_tree(vec)
-            newick = tree.write(format=9)
+            newick = vec_to_newick(vec)
             print(newick, file=fh)
 
 def write_all_newicks(n=4, file="test.log"):
@@ -493,8 +734,7 @@ def write_all_newicks(n=4, file="test.log"):
     all_vecs = get_all_vectors(n)
     with open(file, 'w') as fh:
         for vec in all_vecs:
-            tree = to_tree(vec)
-            newick = tree.write(format=9)
+            newick = vec_to_newick(vec)
             print(newick, file=fh)
 
 def gen_all_newicks(n=4):
@@ -503,8 +743,7 @@ def gen_all_newicks(n=4):
     """
     all_vecs = get_all_vectors(n)
     for vec in all_vecs:
-        tree = to_tree(vec)
-        newick = tree.write(format=9)
+        newick = vec_to_newick(vec)
         yield newick
 
 